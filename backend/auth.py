@@ -7,6 +7,7 @@ import os
 from dotenv import load_dotenv
 from functools import lru_cache
 import base64
+import hmac
 import json
 import time
 
@@ -15,6 +16,7 @@ load_dotenv()
 
 CLERK_SECRET_KEY = os.getenv("CLERK_SECRET_KEY")
 CLERK_PUBLISHABLE_KEY = os.getenv("CLERK_PUBLISHABLE_KEY")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 
 def get_clerk_frontend_api() -> str:
@@ -145,3 +147,18 @@ async def get_optional_user(authorization: Optional[str] = Header(None)) -> Opti
     except Exception as e:
         print(f"Optional user auth failed: {e}")
         return None
+
+
+def is_admin_token(token: Optional[str]) -> bool:
+    """Check a token against ADMIN_TOKEN (admin access is disabled when unset)"""
+    if not ADMIN_TOKEN or not token:
+        return False
+    # compare_digest rejects non-ASCII str, and header values may be any latin-1 text
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+async def verify_admin(x_admin_token: Optional[str] = Header(None)) -> bool:
+    """Require a valid X-Admin-Token header — raises 403 otherwise"""
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return True
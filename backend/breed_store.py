@@ -0,0 +1,327 @@
+# breed_store.py
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# Binary cache layout (native byte order, so the cache is machine-local):
+#   header
+#   grid           uint16[n_keys * n_fields]  value id per breed/field (MISSING if absent)
+#   string index   uint32[n_strings]          byte offset of each string in the pool
+#   value index    uint32[n_values]           word offset of each value in the value words
+#   value words    uint32[n_value_words]      tag, count, payload...
+#   string pool    length-prefixed UTF-8, deduplicated
+# Strings 0..n_keys-1 are breed keys and the next n_fields are field names.
+# Values stay in the mapped file and are only decoded when a record is read.
+CACHE_MAGIC = b"BRDC"
+CACHE_VERSION = 3
+CACHE_HEADER = struct.Struct("=4sHQqIIIIII")  # magic, version, source size, source mtime_ns, counts, pool size
+STRING_LENGTH = struct.Struct("=I")
+MISSING = 0xFFFF
+
+# Value tags
+TAG_STR = 0
+TAG_BOOL = 1
+TAG_LIST = 2
+TAG_JSON = 3  # anything else, stored as a JSON-encoded string
+
+
+def _align(size, alignment=4):
+    """Round a byte offset up to the given alignment"""
+    return (size + alignment - 1) // alignment * alignment
+
+
+def encode_breed_data(data, source_size=0, source_mtime_ns=0):
+    """Encode the parsed breed_info.json dict into the binary cache format"""
+    strings = []
+    string_ids = {}
+
+    def string_id(text):
+        idx = string_ids.get(text)
+        if idx is None:
+            idx = string_ids[text] = len(strings)
+            strings.append(text)
+        return idx
+
+    keys = list(data)
+    fields = []
+    for info in data.values():
+        for field in info:
+            if field not in fields:
+                fields.append(field)
+    for text in keys + fields:
+        strings.append(text)
+    for idx, text in enumerate(strings):
+        string_ids.setdefault(text, idx)
+
+    field_cols = {field: col for col, field in enumerate(fields)}
+    value_offsets = array("I")
+    value_words = array("I")
+    value_ids = {}
+    grid = array("H", [MISSING]) * (len(keys) * len(fields))
+
+    for row, info in enumerate(data.values()):
+        for field, value in info.items():
+            # bool is an int subclass, so keep its type in the dedupe key
+            dedupe_key = (type(value), json.dumps(value))
+            idx = value_ids.get(dedupe_key)
+            if idx is None:
+                idx = value_ids[dedupe_key] = len(value_offsets)
+                value_offsets.append(len(value_words))
+                if isinstance(value, str):
+                    value_words.extend((TAG_STR, 1, string_id(value)))
+                elif isinstance(value, bool):
+                    value_words.extend((TAG_BOOL, 1, int(value)))
+                elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+                    value_words.extend((TAG_LIST, len(value)))
+                    value_words.extend(string_id(v) for v in value)
+                else:
+                    value_words.extend((TAG_JSON, 1, string_id(json.dumps(value))))
+            grid[row * len(fields) + field_cols[field]] = idx
+
+    if len(value_offsets) >= MISSING:
+        raise ValueError(f"Too many distinct breed values for cache: {len(value_offsets)}")
+
+    pool = bytearray()
+    string_offsets = array("I")
+    for text in strings:
+        encoded = text.encode("utf-8")
+        string_offsets.append(len(pool))
+        pool += STRING_LENGTH.pack(len(encoded)) + encoded
+
+    out = bytearray(CACHE_HEADER.pack(
+        CACHE_MAGIC, CACHE_VERSION, source_size, source_mtime_ns,
+        len(keys), len(fields), len(strings), len(value_offsets), len(value_words), len(pool)
+    ))
+    for section in (grid, string_offsets, value_offsets, value_words):
+        out += b"\0" * (_align(len(out)) - len(out))
+        out += section.tobytes()
+    out += pool
+    return bytes(out)
+
+
+class BreedRecord:
+    """Lightweight view of one breed row in a BreedStore"""
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def get(self, field, default=None):
+        """Get a single field value"""
+        col = self._store._field_cols.get(field)
+        if col is None:
+            return default
+        idx = self._store._grid[self._row * self._store._n_fields + col]
+        return default if idx == MISSING else self._store._value(idx)
+
+    def to_dict(self):
+        """Materialize the record as a plain dict"""
+        store = self._store
+        start = self._row * store._n_fields
+        result = {}
+        for col, field in enumerate(store._fields):
+            idx = store._grid[start + col]
+            if idx != MISSING:
+                result[field] = store._value(idx)
+        return result
+
+
+class BreedStore:
+    """Columnar breed database read lazily from the binary cache format"""
+
+    def __init__(self, buffer):
+        if len(buffer) < CACHE_HEADER.size:
+            raise ValueError("breed cache is truncated")
+        (magic, version, self.source_size, self.source_mtime_ns,
+         n_keys, n_fields, n_strings, n_values, n_value_words, pool_size) = CACHE_HEADER.unpack_from(buffer)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError("unrecognized breed cache format")
+
+        self._buffer = buffer  # bytes or mmap; keeps the views below alive
+        self._view = memoryview(buffer)
+        offset = CACHE_HEADER.size
+        sections = []
+        for fmt, count in (("H", n_keys * n_fields), ("I", n_strings), ("I", n_values), ("I", n_value_words)):
+            offset = _align(offset)
+            size = count * struct.calcsize(fmt)
+            if offset + size > len(buffer):
+                raise ValueError("breed cache is truncated")
+            sections.append(self._view[offset:offset + size].cast(fmt))
+            offset += size
+        self._grid, self._string_offsets, self._value_offsets, self._value_words = sections
+        if offset + pool_size > len(buffer):
+            raise ValueError("breed cache is truncated")
+        self._pool = self._view[offset:offset + pool_size]
+
+        self._n_fields = n_fields
+        self._keys = tuple(sys.intern(self._string(i)) for i in range(n_keys))
+        self._fields = tuple(sys.intern(self._string(n_keys + i)) for i in range(n_fields))
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._field_cols = {field: col for col, field in enumerate(self._fields)}
+
+    def _string(self, idx):
+        """Decode one length-prefixed UTF-8 string from the pool"""
+        offset = self._string_offsets[idx]
+        (length,) = STRING_LENGTH.unpack_from(self._pool, offset)
+        start = offset + STRING_LENGTH.size
+        return str(self._pool[start:start + length], "utf-8")
+
+    def _value(self, idx):
+        """Decode one value from the value table"""
+        words = self._value_words
+        offset = self._value_offsets[idx]
+        tag, count = words[offset], words[offset + 1]
+        if tag == TAG_STR:
+            return self._string(words[offset + 2])
+        if tag == TAG_BOOL:
+            return bool(words[offset + 2])
+        if tag == TAG_LIST:
+            return [self._string(words[offset + 2 + i]) for i in range(count)]
+        return json.loads(self._string(words[offset + 2]))
+
+    @classmethod
+    def from_json(cls, json_path):
+        """Parse breed_info.json and encode it in memory, stamped with the file's size and mtime"""
+        source = os.stat(json_path)
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(encode_breed_data(data, source.st_size, source.st_mtime_ns))
+
+    def save_cache(self, cache_path):
+        """Write the encoded store to disk atomically"""
+        # PID-suffixed temp file so workers starting together don't clobber each other
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._view)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def from_cache(cls, cache_path, source_path=None):
+        """Map the binary cache into memory; returns None if missing, unreadable or stale"""
+        try:
+            with open(cache_path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            store = cls(buffer)
+            if source_path and os.path.exists(source_path):
+                source = os.stat(source_path)
+                if (source.st_size, source.st_mtime_ns) != (store.source_size, store.source_mtime_ns):
+                    raise ValueError("breed cache is stale")
+            return store
+        except Exception:
+            return None
+
+    @classmethod
+    def load(cls, json_path, cache_path):
+        """Load from the binary cache, rebuilding it from JSON when missing or stale"""
+        store = cls.from_cache(cache_path, json_path)
+        if store is not None:
+            return store, "cache"
+
+        store = cls.from_json(json_path)
+        try:
+            store.save_cache(cache_path)
+        except OSError as e:
+            print(f"✗ Could not write breed cache {cache_path}: {e}")
+        return store, "json"
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __getitem__(self, key):
+        return BreedRecord(self, self._rows[key])
+
+    def keys(self):
+        """Breed keys in source order"""
+        return self._keys
+
+    def get(self, key, default=None):
+        """Get a breed record by exact key"""
+        row = self._rows.get(key)
+        return default if row is None else BreedRecord(self, row)
+
+
+def _rss_kb():
+    """Current resident set size in KB (Linux)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def _measure(mode, metric, json_path, cache_path):
+    """Measure one load in a fresh interpreter: wall time and RSS, or Python heap"""
+    import gc
+    import time
+    import tracemalloc
+
+    def load():
+        if mode == "json":
+            with open(json_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return BreedStore.from_cache(cache_path, json_path)
+
+    gc.collect()
+    if metric == "heap":
+        tracemalloc.start()
+        data = load()
+        gc.collect()
+        result = {"heap_kb": tracemalloc.get_traced_memory()[0] // 1024}
+        tracemalloc.stop()
+    else:
+        rss_before = _rss_kb()
+        start = time.perf_counter()
+        data = load()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        gc.collect()
+        result = {"load_ms": round(elapsed_ms, 2), "rss_kb": _rss_kb() - rss_before}
+
+    result["breeds"] = len(data)
+    print(json.dumps(result))
+
+
+def _benchmark(json_path, cache_path, runs=5):
+    """Compare JSON parsing against the mmap cache, each run in a fresh interpreter"""
+    import subprocess
+
+    BreedStore.from_json(json_path).save_cache(cache_path)
+    for mode in ("json", "cache"):
+        results = {}
+        for metric in ("time", "heap"):
+            for _ in range(runs):
+                out = subprocess.run(
+                    [sys.executable, __file__, "--measure", mode, metric, json_path, cache_path],
+                    capture_output=True, text=True, check=True
+                ).stdout
+                for name, value in json.loads(out).items():
+                    results.setdefault(name, []).append(value)
+
+        load_ms, rss_kb, heap_kb = (sorted(results[name])[runs // 2] for name in ("load_ms", "rss_kb", "heap_kb"))
+        print(f"{mode:>5}: median load {load_ms:.2f} ms, RSS +{rss_kb} KB, Python heap {heap_kb} KB")
+
+
+if __name__ == "__main__":
+    json_path = "models/breed_info.json"
+    cache_path = "models/breed_info.bin"
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        _measure(*sys.argv[2:6])
+    elif len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        _benchmark(json_path, cache_path)
+    else:
+        store = BreedStore.from_json(json_path)
+        store.save_cache(cache_path)
+        print(f"✓ Wrote {cache_path} ({len(store)} breeds, {len(store._value_offsets)} distinct values)")
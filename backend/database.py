@@ -4,6 +4,7 @@ from pymongo.errors import ConnectionFailure
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from profiling import timed
 
 load_dotenv()
 
@@ -71,7 +72,9 @@ class PredictionDB:
         self.collection.create_index("user_id")
         self.collection.create_index("timestamp")
     
-    def save_prediction(self, user_id, breed, confidence, image_name=None):
+    @timed("db.save_prediction")
+    def save_prediction(self, user_id, breed, confidence, image_name=None,
+                        embedding=None, top_predictions=None):
         """Save a prediction to database"""
         prediction = {
             "user_id": user_id,
@@ -80,13 +83,19 @@ class PredictionDB:
             "image_name": image_name,
             "timestamp": datetime.utcnow()
         }
+        if embedding is not None:
+            prediction["embedding"] = embedding  # float16 bytes
+        if top_predictions is not None:
+            prediction["top_predictions"] = top_predictions
         result = self.collection.insert_one(prediction)
         return str(result.inserted_id)
     
+    @timed("db.get_user_predictions")
     def get_user_predictions(self, user_id, limit=50):
         """Get user's prediction history"""
         predictions = self.collection.find(
-            {"user_id": user_id}
+            {"user_id": user_id},
+            {"embedding": 0}
         ).sort("timestamp", -1).limit(limit)
         
         return [{
@@ -97,10 +106,32 @@ class PredictionDB:
             "timestamp": pred["timestamp"].isoformat()
         } for pred in predictions]
     
+    @timed("db.get_user_embeddings")
+    def get_user_embeddings(self, user_id, since=None, limit=1000):
+        """Get a user's most recent predictions with a stored embedding, oldest first"""
+        query = {"user_id": user_id, "embedding": {"$exists": True}}
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        
+        predictions = list(self.collection.find(query).sort("timestamp", -1).limit(limit))
+        predictions.reverse()
+        
+        return [{
+            "id": str(pred["_id"]),
+            "breed": pred["breed"],
+            "confidence": pred["confidence"],
+            "image_name": pred.get("image_name"),
+            "timestamp": pred["timestamp"],
+            "top_predictions": pred.get("top_predictions", []),
+            "embedding": pred["embedding"]
+        } for pred in predictions]
+    
+    @timed("db.get_prediction_count")
     def get_prediction_count(self, user_id):
         """Get total predictions for a user"""
         return self.collection.count_documents({"user_id": user_id})
     
+    @timed("db.get_breed_stats")
     def get_breed_stats(self, user_id):
         """Get breed prediction statistics for a user"""
         pipeline = [
@@ -129,6 +160,7 @@ class UserDB:
         # Create unique index on user_id
         self.collection.create_index("user_id", unique=True)
     
+    @timed("db.create_or_update_user")
     def create_or_update_user(self, user_id, email=None, name=None):
         """Create or update user profile"""
         user_data = {
@@ -150,6 +182,7 @@ class UserDB:
         
         return result.upserted_id or result.matched_count > 0
     
+    @timed("db.get_user")
     def get_user(self, user_id):
         """Get user by ID"""
         user = self.collection.find_one({"user_id": user_id})
@@ -157,6 +190,7 @@ class UserDB:
             user["_id"] = str(user["_id"])
         return user
     
+    @timed("db.update_last_active")
     def update_last_active(self, user_id):
         """Update user's last active timestamp"""
         self.collection.update_one(
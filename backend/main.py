@@ -1,4 +1,4 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 import tensorflow as tf
 import numpy as np
@@ -6,12 +6,18 @@ from PIL import Image
 import io
 import json
 import os
+import threading
+import time
 from datetime import datetime
 from typing import Optional
 
 # Import our custom modules
-from auth import get_current_user, get_optional_user
+from auth import get_current_user, get_optional_user, is_admin_token, verify_admin
 from database import mongodb, prediction_db, user_db
+from similarity import SimilarityIndex, encode_embedding, decode_embedding
+from breed_store import BreedStore
+import profiling
+from profiling import stage
 
 app = FastAPI(title="Dog Breed Predictor API", version="2.0.0")
 
@@ -29,23 +35,124 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def capture_request_traces(request: Request, call_next):
+    """Record stage timings per request and keep slow or profiled ones"""
+    # Admins can force profiling with X-Profile: 1; otherwise sample at PROFILE_SAMPLE_RATE
+    if request.headers.get("x-profile") == "1" and is_admin_token(request.headers.get("x-admin-token")):
+        reason = "admin"
+    elif profiling.should_sample():
+        reason = "sampled"
+    else:
+        reason = None
+    
+    trace, token = profiling.start_trace(request.method, request.url.path)
+    sampler = profiling.start_sampler(threading.get_ident()) if reason else None
+    if reason and sampler is None:
+        trace.profile = {"skipped": "another request is being profiled"}
+    try:
+        response = await call_next(request)
+        trace.status_code = response.status_code
+        return response
+    finally:
+        trace.finish()
+        if sampler:
+            trace.profile = profiling.stop_sampler(sampler)
+        profiling.end_trace(token)
+        
+        if reason is None and trace.duration_ms >= profiling.SLOW_REQUEST_MS:
+            reason = "slow"
+        if reason:
+            profiling.trace_buffer.append(trace.to_dict(reason))
+
+# Profiling middleware is only installed when enabled, so it costs nothing otherwise
+if profiling.PROFILING_ENABLED:
+    app.middleware("http")(capture_request_traces)
+
 # Configuration
 MODEL_PATH = "models/best_phaseB.keras"
 BREED_INFO_PATH = "models/breed_info.json"
+BREED_CACHE_PATH = "models/breed_info.bin"
 CLASS_INDICES_PATH = "models/class_indices.json"
 
+# Test-time augmentation (TTA) for low-confidence predictions
+TTA_ENABLED = os.getenv("TTA_ENABLED", "false").lower() == "true"
+TTA_CONFIDENCE_THRESHOLD = float(os.getenv("TTA_CONFIDENCE_THRESHOLD", "0.6"))
+TTA_NUM_VARIANTS = int(os.getenv("TTA_NUM_VARIANTS", "4"))
+
+# Normalized [y1, x1, y2, x2] crop boxes used to build TTA variants.
+# A box with x1 > x2 yields a horizontally flipped crop.
+TTA_BOXES = [
+    [0.0, 1.0, 1.0, 0.0],            # horizontal flip
+    [0.0625, 0.0625, 0.9375, 0.9375],  # center crop
+    [0.0625, 0.9375, 0.9375, 0.0625],  # flipped center crop
+    [0.0, 0.0, 0.875, 0.875],        # top-left crop
+    [0.0, 0.125, 0.875, 1.0],        # top-right crop
+    [0.125, 0.0, 1.0, 0.875],        # bottom-left crop
+    [0.125, 0.125, 1.0, 1.0],        # bottom-right crop
+]
+
+# Embedding similarity ("looks like" search and near-duplicate detection)
+SIMILARITY_BACKEND = os.getenv("SIMILARITY_BACKEND", "bruteforce")
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv("DUPLICATE_SIMILARITY_THRESHOLD", "0.98"))
+SIMILARITY_CACHE_USERS = int(os.getenv("SIMILARITY_CACHE_USERS", "1000"))
+SIMILARITY_CACHE_TTL_SECONDS = float(os.getenv("SIMILARITY_CACHE_TTL_SECONDS", "300"))
+EMBEDDING_LOAD_LIMIT = int(os.getenv("EMBEDDING_LOAD_LIMIT", "1000"))
+
 # Global variables
 model = None
+feature_extractor = None
+classifier_head = None
+similarity_index = SimilarityIndex(
+    SIMILARITY_BACKEND,
+    max_users=SIMILARITY_CACHE_USERS,
+    ttl_seconds=SIMILARITY_CACHE_TTL_SECONDS
+)
 breed_database = {}
+breed_lookup = {}
 class_names = []
+tta_metrics = {
+    "predictions": 0,
+    "triggered": 0,
+    "top1_changed": 0,
+    "total_latency_ms": 0.0,
+    "max_latency_ms": 0.0
+}
+
+# Returned for breeds missing from the database (shared, never mutated)
+DEFAULT_BREED_INFO = {
+    "size": "Medium",
+    "temperament": ["Friendly", "Intelligent"],
+    "energy_level": "Moderate",
+    "life_span": "10-15 years",
+    "group": "Not specified",
+    "good_with_kids": "Unknown",
+    "good_with_pets": "Unknown",
+    "trainability": "Moderate",
+    "origin": "Unknown",
+    "exercise_needs": "Moderate",
+    "grooming_needs": "Moderate",
+    "barking_tendency": "Moderate",
+    "bred_for": "Companionship",
+    "weight_range": "Unknown",
+    "height_range": "Unknown",
+    "coat_type": "Unknown",
+    "colors": ["Various"],
+    "mental_stimulation_needs": "Moderate",
+    "prey_drive": "Moderate",
+    "sensitivity_level": "Moderate",
+    "daily_food_amount": "Unknown",
+    "calorie_requirements": "Unknown"
+}
 
 def load_breed_database():
-    """Load breed information from JSON file"""
-    global breed_database
+    """Load breed information from the binary cache, falling back to JSON"""
+    global breed_database, breed_lookup
     try:
-        with open(BREED_INFO_PATH, 'r', encoding='utf-8') as f:
-            breed_database = json.load(f)
-        print(f"✓ Loaded {len(breed_database)} breeds from database")
+        breed_database, source = BreedStore.load(BREED_INFO_PATH, BREED_CACHE_PATH)
+        breed_lookup = {
+            normalize_breed_name(key).lower(): key for key in breed_database.keys()
+        }
+        print(f"✓ Loaded {len(breed_database)} breeds from database ({source})")
         return True
     except FileNotFoundError:
         print(f"✗ Warning: {BREED_INFO_PATH} not found")
@@ -53,6 +160,9 @@ def load_breed_database():
     except json.JSONDecodeError as e:
         print(f"✗ Error parsing breed_info.json: {e}")
         return False
+    except OSError as e:
+        print(f"✗ Error reading breed database: {e}")
+        return False
 
 def load_class_indices():
     """Load class indices mapping"""
@@ -84,6 +194,7 @@ def load_model():
         if os.path.exists(MODEL_PATH):
             model = tf.keras.models.load_model(MODEL_PATH)
             print(f"✓ Model loaded successfully from {MODEL_PATH}")
+            build_embedding_model()
             return True
         else:
             print(f"✗ Model file not found: {MODEL_PATH}")
@@ -92,6 +203,77 @@ def load_model():
         print(f"✗ Error loading model: {e}")
         return False
 
+def build_embedding_model():
+    """Split the model into a penultimate-layer feature extractor and classifier head"""
+    global feature_extractor, classifier_head
+    try:
+        # Walk back to the last Dense layer; anything after it (e.g. a float32
+        # Activation('softmax') under mixed precision) stays part of the head
+        dense_idx = next(
+            (i for i in range(len(model.layers) - 1, -1, -1)
+             if isinstance(model.layers[i], tf.keras.layers.Dense)),
+            None
+        )
+        if dense_idx is None:
+            raise ValueError("model has no Dense classifier layer")
+        
+        head_layers = model.layers[dense_idx:]
+        if not all(isinstance(layer, (tf.keras.layers.Activation, tf.keras.layers.Softmax))
+                   for layer in head_layers[1:]):
+            raise ValueError("unexpected layers after the Dense classifier")
+        if not is_softmax_layer(head_layers[-1]):
+            raise ValueError("classifier head does not end in softmax")
+        
+        feature_extractor = tf.keras.Model(inputs=model.inputs, outputs=head_layers[0].input)
+        classifier_head = head_layers
+        print(f"✓ Embedding extractor ready ({feature_extractor.output_shape[-1]}-dim)")
+        return True
+    except Exception as e:
+        feature_extractor = None
+        classifier_head = None
+        print(f"✗ Could not build embedding extractor: {e}")
+        return False
+
+def is_softmax_layer(layer):
+    """Check whether a layer applies a softmax activation"""
+    if isinstance(layer, tf.keras.layers.Softmax):
+        return True
+    activation = getattr(layer, "activation", None)
+    return getattr(activation, "__name__", None) == "softmax"
+
+def extract_embeddings(img_batch):
+    """Return penultimate-layer embeddings, or None if no extractor is available"""
+    if feature_extractor is None:
+        return None
+    return feature_extractor.predict(img_batch, verbose=0)
+
+def run_classifier(img_batch, embeddings=None):
+    """Return softmax probabilities, reusing precomputed embeddings when given"""
+    if feature_extractor is None:
+        return model.predict(img_batch, verbose=0)
+    if embeddings is None:
+        embeddings = feature_extractor.predict(img_batch, verbose=0)
+    outputs = embeddings
+    for layer in classifier_head:
+        outputs = layer(outputs, training=False)
+    return np.asarray(outputs)
+
+def load_user_embeddings(user_id):
+    """Sync a user's similarity index with MongoDB, fetching only newer predictions"""
+    since = similarity_index.last_timestamp(user_id)
+    predictions = prediction_db.get_user_embeddings(
+        user_id, since=since, limit=EMBEDDING_LOAD_LIMIT
+    )
+    
+    similarity_index.ensure_user(user_id)
+    for pred in predictions:
+        prediction_id = pred.pop("id")
+        embedding = decode_embedding(pred.pop("embedding"))
+        timestamp = pred["timestamp"]
+        pred["timestamp"] = timestamp.isoformat()
+        similarity_index.add(user_id, prediction_id, embedding, metadata=pred)
+        similarity_index.mark_loaded(user_id, timestamp)
+
 def preprocess_image(image_bytes):
     """Preprocess image for model prediction"""
     try:
@@ -109,42 +291,46 @@ def preprocess_image(image_bytes):
     except Exception as e:
         raise ValueError(f"Image preprocessing failed: {str(e)}")
 
+def generate_tta_variants(img_array, num_variants):
+    """Build flipped/cropped variants of a preprocessed (1, 224, 224, 3) image"""
+    num_variants = max(1, min(num_variants, len(TTA_BOXES)))
+    boxes = tf.constant(TTA_BOXES[:num_variants], dtype=tf.float32)
+    box_indices = tf.zeros([num_variants], dtype=tf.int32)
+    crop_size = img_array.shape[1:3]
+    
+    variants = tf.image.crop_and_resize(img_array, boxes, box_indices, crop_size)
+    return variants.numpy()
+
+def predict_with_tta(img_array, base_probs, num_variants=TTA_NUM_VARIANTS):
+    """Average probabilities over the original image and a batch of TTA variants"""
+    start = time.perf_counter()
+    
+    variants = generate_tta_variants(img_array, num_variants)
+    variant_probs = run_classifier(variants)
+    averaged = np.vstack([base_probs[np.newaxis, :], variant_probs]).mean(axis=0)
+    
+    latency_ms = (time.perf_counter() - start) * 1000
+    
+    tta_metrics["triggered"] += 1
+    tta_metrics["total_latency_ms"] += latency_ms
+    tta_metrics["max_latency_ms"] = max(tta_metrics["max_latency_ms"], latency_ms)
+    if int(np.argmax(averaged)) != int(np.argmax(base_probs)):
+        tta_metrics["top1_changed"] += 1
+    
+    return averaged, len(variants), latency_ms
+
 def normalize_breed_name(name):
     """Normalize breed name for consistent lookup"""
     return name.replace('_', ' ').replace('-', ' ').strip()
 
 def get_breed_info(breed_name):
     """Get breed information from database"""
-    normalized = normalize_breed_name(breed_name)
+    key = breed_lookup.get(normalize_breed_name(breed_name).lower())
     
-    for key in breed_database.keys():
-        if normalize_breed_name(key).lower() == normalized.lower():
-            return breed_database[key]
+    if key is not None:
+        return breed_database[key].to_dict()
     
-    return {
-        "size": "Medium",
-        "temperament": ["Friendly", "Intelligent"],
-        "energy_level": "Moderate",
-        "life_span": "10-15 years",
-        "group": "Not specified",
-        "good_with_kids": "Unknown",
-        "good_with_pets": "Unknown",
-        "trainability": "Moderate",
-        "origin": "Unknown",
-        "exercise_needs": "Moderate",
-        "grooming_needs": "Moderate",
-        "barking_tendency": "Moderate",
-        "bred_for": "Companionship",
-        "weight_range": "Unknown",
-        "height_range": "Unknown",
-        "coat_type": "Unknown",
-        "colors": ["Various"],
-        "mental_stimulation_needs": "Moderate",
-        "prey_drive": "Moderate",
-        "sensitivity_level": "Moderate",
-        "daily_food_amount": "Unknown",
-        "calorie_requirements": "Unknown"
-    }
+    return DEFAULT_BREED_INFO
 
 @app.on_event("startup")
 async def startup_event():
@@ -190,12 +376,33 @@ async def health_check():
         "breeds_in_database": len(breed_database),
         "total_classes": len(class_names),
         "mongodb_connected": mongodb._client is not None,
+        "embedding_extractor_ready": feature_extractor is not None,
+        "similarity_backend": SIMILARITY_BACKEND,
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/metrics/tta")
+async def get_tta_metrics():
+    """Test-time augmentation trigger rate and latency cost (Public)"""
+    predictions = tta_metrics["predictions"]
+    triggered = tta_metrics["triggered"]
+    
+    return {
+        "enabled": TTA_ENABLED,
+        "confidence_threshold": TTA_CONFIDENCE_THRESHOLD,
+        "num_variants": TTA_NUM_VARIANTS,
+        "predictions": predictions,
+        "triggered": triggered,
+        "trigger_rate": round(triggered / predictions, 4) if predictions else 0.0,
+        "top1_changed": tta_metrics["top1_changed"],
+        "avg_latency_ms": round(tta_metrics["total_latency_ms"] / triggered, 2) if triggered else 0.0,
+        "max_latency_ms": round(tta_metrics["max_latency_ms"], 2)
+    }
+
 @app.post("/predict")
 async def predict(
     file: UploadFile = File(...),
+    tta: Optional[bool] = None,
     current_user: dict = Depends(get_optional_user)  # Changed to optional!
 ):
     """Predict dog breed from uploaded image (Now Public - Auth Optional)"""
@@ -218,13 +425,65 @@ async def predict(
             user_db.update_last_active(current_user["user_id"])
         
         # Read and preprocess image
-        image_bytes = await file.read()
-        processed_image = preprocess_image(image_bytes)
+        with stage("read_upload"):
+            image_bytes = await file.read()
+        with stage("preprocess"):
+            processed_image = preprocess_image(image_bytes)
+        
+        # Extract the penultimate-layer embedding before the classifier head
+        with stage("embedding"):
+            embedding = extract_embeddings(processed_image)
+        
+        # Serve near-duplicate uploads from the user's earlier prediction
+        if current_user and embedding is not None:
+            with stage("duplicate_check"):
+                load_user_embeddings(current_user["user_id"])
+                duplicate = similarity_index.find_duplicate(
+                    current_user["user_id"], embedding[0], DUPLICATE_SIMILARITY_THRESHOLD
+                )
+            if duplicate:
+                return {
+                    "success": True,
+                    "prediction_id": duplicate["prediction_id"],
+                    "duplicate_of": duplicate["prediction_id"],
+                    "similarity": duplicate["similarity"],
+                    "prediction": {
+                        "breed": duplicate["breed"],
+                        "confidence": duplicate["confidence"],
+                        "percentage": round(duplicate["confidence"] * 100, 2)
+                    },
+                    "top_predictions": duplicate["top_predictions"],
+                    "breed_info": get_breed_info(duplicate["breed"]),
+                    "tta": {"applied": False},
+                    "timestamp": datetime.now().isoformat(),
+                    "authenticated": True
+                }
         
         # Make prediction
-        predictions = model.predict(processed_image, verbose=0)
+        with stage("classify"):
+            predictions = run_classifier(processed_image, embedding)
         predicted_idx = int(np.argmax(predictions[0]))
         confidence = float(predictions[0][predicted_idx])
+        tta_metrics["predictions"] += 1
+        
+        # Re-run low-confidence predictions with test-time augmentation
+        # (?tta=false lets callers opt out; it cannot force TTA on)
+        use_tta = TTA_ENABLED and tta is not False
+        tta_info = {"applied": False}
+        if use_tta and confidence < TTA_CONFIDENCE_THRESHOLD:
+            with stage("tta"):
+                averaged, num_variants, tta_latency_ms = predict_with_tta(
+                    processed_image, predictions[0]
+                )
+            predictions = averaged[np.newaxis, :]
+            predicted_idx = int(np.argmax(predictions[0]))
+            tta_info = {
+                "applied": True,
+                "variants": num_variants,
+                "original_confidence": confidence,
+                "latency_ms": round(tta_latency_ms, 2)
+            }
+            confidence = float(predictions[0][predicted_idx])
         
         # Get breed name
         if predicted_idx < len(class_names):
@@ -236,7 +495,8 @@ async def predict(
         breed_display = normalize_breed_name(breed_name).title()
         
         # Get breed information
-        breed_info = get_breed_info(breed_name)
+        with stage("breed_info"):
+            breed_info = get_breed_info(breed_name)
         
         # Get top 3 predictions
         top_3_indices = np.argsort(predictions[0])[-3:][::-1]
@@ -258,12 +518,30 @@ async def predict(
                 user_id=current_user["user_id"],
                 breed=breed_display,
                 confidence=confidence,
-                image_name=file.filename
+                image_name=file.filename,
+                embedding=encode_embedding(embedding[0]) if embedding is not None else None,
+                top_predictions=top_predictions
             )
+            
+            if embedding is not None:
+                with stage("index_embedding"):
+                    similarity_index.add(
+                        current_user["user_id"],
+                        prediction_id,
+                        embedding[0],
+                        metadata={
+                            "breed": breed_display,
+                            "confidence": confidence,
+                            "image_name": file.filename,
+                            "timestamp": datetime.utcnow().isoformat(),
+                            "top_predictions": top_predictions
+                        }
+                    )
         
         return {
             "success": True,
             "prediction_id": prediction_id,
+            "duplicate_of": None,
             "prediction": {
                 "breed": breed_display,
                 "confidence": confidence,
@@ -271,6 +549,7 @@ async def predict(
             },
             "top_predictions": top_predictions,
             "breed_info": breed_info,
+            "tta": tta_info,
             "timestamp": datetime.now().isoformat(),
             "authenticated": current_user is not None
         }
@@ -284,6 +563,95 @@ async def predict(
             detail=f"Prediction failed: {str(e)}"
         )
 
+@app.post("/similar")
+async def find_similar_predictions(
+    file: UploadFile = File(...),
+    k: int = Query(5, ge=1, le=50),
+    current_user: dict = Depends(get_current_user)
+):
+    """Find the user's previous photos most similar to an upload (Protected)"""
+    if feature_extractor is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Embedding extractor not available."
+        )
+    
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=400,
+            detail="File must be an image (JPG, PNG, WebP)"
+        )
+    
+    try:
+        image_bytes = await file.read()
+        embedding = extract_embeddings(preprocess_image(image_bytes))
+        
+        load_user_embeddings(current_user["user_id"])
+        similar = similarity_index.search(current_user["user_id"], embedding[0], k=k)
+        
+        return {
+            "success": True,
+            "similar": similar
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Similarity search failed: {str(e)}"
+        )
+
+@app.get("/predictions/{prediction_id}/similar")
+async def get_similar_predictions(
+    prediction_id: str,
+    k: int = Query(5, ge=1, le=50),
+    current_user: dict = Depends(get_current_user)
+):
+    """Find the user's previous photos most similar to a past prediction (Protected)"""
+    try:
+        load_user_embeddings(current_user["user_id"])
+        embedding = similarity_index.get_embedding(current_user["user_id"], prediction_id)
+        
+        if embedding is None:
+            raise HTTPException(
+                status_code=404,
+                detail="No embedding stored for this prediction"
+            )
+        
+        similar = similarity_index.search(
+            current_user["user_id"], embedding, k=k, exclude=prediction_id
+        )
+        
+        return {
+            "success": True,
+            "prediction_id": prediction_id,
+            "similar": similar
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Similarity search failed: {str(e)}"
+        )
+
+@app.get("/admin/traces")
+async def get_request_traces(clear: bool = False, _: bool = Depends(verify_admin)):
+    """Dump captured slow/profiled request traces (Admin)"""
+    traces = list(profiling.trace_buffer)
+    if clear:
+        profiling.trace_buffer.clear()
+    
+    return {
+        "success": True,
+        "enabled": profiling.PROFILING_ENABLED,
+        "slow_request_ms": profiling.SLOW_REQUEST_MS,
+        "sample_rate": profiling.PROFILE_SAMPLE_RATE,
+        "capacity": profiling.trace_buffer.maxlen,
+        "profile_scope": profiling.PROFILE_SCOPE,
+        "traces": traces
+    }
+
 @app.get("/history")
 async def get_prediction_history(
     limit: int = 50,
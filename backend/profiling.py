@@ -0,0 +1,186 @@
+# profiling.py
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Profiling is opt-in; when disabled no trace is ever active and stage()/timed()
+# cost a single context variable lookup.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.0"))
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "50"))
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_NULL_STAGE = nullcontext()
+
+# Bounded ring buffer of captured traces (oldest dropped first)
+trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+
+PROFILE_SCOPE = "event_loop_thread"
+_sampler_lock = threading.Lock()
+
+
+class StackSampler:
+    """Sampling profiler that periodically records one thread's Python stack.
+
+    Requests share the event-loop thread (including the synchronous TF and Mongo
+    calls), so a profile covers everything that ran on the loop while the
+    sampled request was in flight, not just that request. For the same reason
+    only one sampler runs at a time (see start_sampler).
+    """
+
+    def __init__(self, thread_id, interval_ms=PROFILER_INTERVAL_MS):
+        self._thread_id = thread_id
+        self._interval = interval_ms / 1000
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self.interval_ms = interval_ms
+        self.samples = 0
+
+    def start(self):
+        """Start sampling in a background daemon thread"""
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+
+            self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, limit=50):
+        """Stop sampling and return the most frequent collapsed stacks"""
+        self._stop.set()
+        self._thread.join()
+        return {
+            "interval_ms": self.interval_ms,
+            "samples": self.samples,
+            "stacks": [
+                {"stack": stack, "count": count}
+                for stack, count in self._stacks.most_common(limit)
+            ]
+        }
+
+
+class RequestTrace:
+    """Stage-timing breakdown for a single request"""
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.status_code = None
+        self.duration_ms = None
+        self.stages = []
+        self.profile = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of work as a named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stages.append({
+                "name": name,
+                "start_ms": round((start - self._start) * 1000, 2),
+                "duration_ms": round((end - start) * 1000, 2)
+            })
+
+    def finish(self):
+        """Record the total request duration"""
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self, reason):
+        """Serialize the trace for the admin dump"""
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms, 2),
+            "reason": reason,
+            "stages": self.stages,
+            "profile": self.profile
+        }
+
+
+def start_trace(method, path):
+    """Activate a trace for the current request context"""
+    trace = RequestTrace(method, path)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    """Deactivate the current request's trace"""
+    _current_trace.reset(token)
+
+
+def start_sampler(thread_id):
+    """Start a stack sampler unless one is already running; returns None if busy"""
+    if not _sampler_lock.acquire(blocking=False):
+        return None
+    try:
+        return StackSampler(thread_id).start()
+    except Exception:
+        _sampler_lock.release()
+        raise
+
+
+def stop_sampler(sampler):
+    """Stop a sampler started by start_sampler and return its profile"""
+    try:
+        return sampler.stop()
+    finally:
+        _sampler_lock.release()
+
+
+def should_sample():
+    """Decide whether to profile a request based on PROFILE_SAMPLE_RATE"""
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def stage(name):
+    """Time a block as a stage of the active request trace (no-op without one)"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_STAGE
+    return trace.stage(name)
+
+
+def timed(name):
+    """Decorator recording each call as a stage of the active request trace"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with trace.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
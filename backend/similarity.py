@@ -0,0 +1,205 @@
+# similarity.py
+import time
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Embeddings are L2-normalized and stored as float16 (half the size of float32)
+EMBEDDING_DTYPE = np.float16
+
+
+def normalize_embedding(vector):
+    """L2-normalize an embedding so dot products are cosine similarities"""
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def encode_embedding(vector) -> bytes:
+    """Serialize an embedding into compact float16 bytes for storage"""
+    return normalize_embedding(vector).astype(EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(blob) -> np.ndarray:
+    """Deserialize float16 embedding bytes"""
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+
+
+class BruteForceBackend:
+    """Exact cosine search over a growable float16 matrix"""
+
+    def __init__(self, dim, initial_capacity=16):
+        self._vectors = np.empty((initial_capacity, dim), dtype=EMBEDDING_DTYPE)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, vector):
+        """Append a normalized vector and return its row number"""
+        if self._size == len(self._vectors):
+            grown = np.empty((len(self._vectors) * 2, self._vectors.shape[1]), dtype=EMBEDDING_DTYPE)
+            grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+
+        self._vectors[self._size] = vector
+        self._size += 1
+        return self._size - 1
+
+    def get(self, row):
+        """Return the stored vector at a row"""
+        return self._vectors[row].astype(np.float32)
+
+    def search(self, query, k):
+        """Return (rows, similarities) of the k nearest vectors"""
+        if self._size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = self._vectors[:self._size].astype(np.float32) @ query
+        k = min(k, self._size)
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return rows, scores[rows]
+
+
+class HNSWBackend:
+    """Approximate cosine search backed by hnswlib (optional dependency)"""
+
+    def __init__(self, dim, initial_capacity=16):
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=initial_capacity, ef_construction=200, M=16)
+        self._index.set_ef(50)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, vector):
+        """Insert a normalized vector and return its row number"""
+        if self._size == self._index.get_max_elements():
+            self._index.resize_index(self._size * 2)
+
+        self._index.add_items(vector[np.newaxis, :].astype(np.float32), [self._size])
+        self._size += 1
+        return self._size - 1
+
+    def get(self, row):
+        """Return the stored vector at a row"""
+        return np.asarray(self._index.get_items([row])[0], dtype=np.float32)
+
+    def search(self, query, k):
+        """Return (rows, similarities) of the k nearest vectors"""
+        if self._size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        labels, distances = self._index.knn_query(query[np.newaxis, :], k=min(k, self._size))
+        return labels[0], 1.0 - distances[0]
+
+
+BACKENDS = {
+    "bruteforce": BruteForceBackend,
+    "hnsw": HNSWBackend
+}
+
+
+class SimilarityIndex:
+    """Per-user in-memory nearest-neighbour indexes, kept in a bounded LRU with idle expiry"""
+
+    def __init__(self, backend="bruteforce", max_users=1000, ttl_seconds=300):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown similarity backend: {backend}")
+        if backend == "hnsw" and hnswlib is None:
+            raise ValueError("SIMILARITY_BACKEND=hnsw requires the hnswlib package")
+        self.backend = backend
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._users = OrderedDict()
+
+    def _touch(self, user_id):
+        """Return a user's index, dropping it if idle too long and marking it recently used"""
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        now = time.monotonic()
+        if now - user["last_used"] > self.ttl_seconds:
+            del self._users[user_id]
+            return None
+        user["last_used"] = now
+        self._users.move_to_end(user_id)
+        return user
+
+    def ensure_user(self, user_id):
+        """Register a user with an empty index, evicting the least recently used"""
+        user = self._touch(user_id)
+        if user is None:
+            user = self._users[user_id] = {
+                "index": None,
+                "entries": [],
+                "rows": {},
+                "last_used": time.monotonic(),
+                "last_timestamp": None
+            }
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return user
+
+    def last_timestamp(self, user_id):
+        """Newest stored prediction timestamp loaded for a user (None if not loaded)"""
+        user = self._touch(user_id)
+        return user["last_timestamp"] if user else None
+
+    def mark_loaded(self, user_id, timestamp):
+        """Record that a user's predictions up to a timestamp have been loaded"""
+        user = self.ensure_user(user_id)
+        if timestamp is not None and (user["last_timestamp"] is None or timestamp > user["last_timestamp"]):
+            user["last_timestamp"] = timestamp
+
+    def add(self, user_id, prediction_id, embedding, metadata=None):
+        """Index an embedding under a user's prediction (ignored if already indexed)"""
+        user = self.ensure_user(user_id)
+        if prediction_id in user["rows"]:
+            return user["rows"][prediction_id]
+
+        vector = normalize_embedding(embedding)
+        if user["index"] is None:
+            user["index"] = BACKENDS[self.backend](dim=vector.shape[0])
+
+        row = user["index"].add(vector)
+        user["entries"].append({"prediction_id": prediction_id, **(metadata or {})})
+        user["rows"][prediction_id] = row
+        return row
+
+    def get_embedding(self, user_id, prediction_id):
+        """Return the stored embedding for a prediction, or None"""
+        user = self._touch(user_id)
+        if not user or prediction_id not in user["rows"]:
+            return None
+        return user["index"].get(user["rows"][prediction_id])
+
+    def search(self, user_id, embedding, k=5, exclude=None):
+        """Find a user's k most similar predictions to an embedding"""
+        user = self._touch(user_id)
+        if not user or user["index"] is None:
+            return []
+
+        query = normalize_embedding(embedding)
+        rows, scores = user["index"].search(query, k + (1 if exclude else 0))
+
+        results = []
+        for row, score in zip(rows, scores):
+            entry = user["entries"][int(row)]
+            if entry["prediction_id"] == exclude:
+                continue
+            results.append({**entry, "similarity": round(float(score), 4)})
+        return results[:k]
+
+    def find_duplicate(self, user_id, embedding, threshold):
+        """Return the closest prediction if it is a near-duplicate, else None"""
+        matches = self.search(user_id, embedding, k=1)
+        if matches and matches[0]["similarity"] >= threshold:
+            return matches[0]
+        return None